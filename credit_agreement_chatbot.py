@@ -5,21 +5,47 @@ and compliance certificates.
 """
 
 import os
+import re
+import asyncio
+import json
 import time
+import uuid
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 import logging
 
+import faiss
+import msgpack
+import numpy as np
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, DirectoryLoader
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy, maximal_marginal_relevance
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain_community.chat_models import ChatOpenAI
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+
+try:
+    import numba
+except ImportError:  # numba is optional; pooling falls back to numpy
+    numba = None
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional; falls back to a compiled regex
+    ahocorasick = None
 
 # Configure logging
 logging.basicConfig(
@@ -28,6 +54,599 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# IVFPQ index layout: OPQ rotation, 256 inverted lists, 48 sub-quantizers of 8 bits each
+IVF_LISTS = 256
+PQ_SUBQUANTIZERS = 48
+PQ_BITS = 8
+# FAISS recommends ~39 training points per centroid; below that a flat index is used
+MIN_TRAINING_POINTS = IVF_LISTS * 39
+# Training uses at most this many vectors, so its cost stays bounded as the corpus grows
+TRAINING_SAMPLE_SIZE = IVF_LISTS * 50
+# Trained quantizers are reused until the corpus outgrows the one they were trained on by this factor
+RETRAIN_GROWTH = 2.0
+# Each embedding worker loads its own model, so tiny shards are not worth a process
+MIN_TEXTS_PER_WORKER = 64
+# Chunks are embedded in buffers of this size while files are streamed in
+EMBEDDING_BUFFER_SIZE = 512
+
+# File types picked up from the documents directory
+DOCUMENT_SUFFIXES = (".pdf", ".docx")
+
+# Section/article headings: a plain str.find locates the keyword and a regex
+# only runs on a hit to read the number that follows it
+_SECTION_NUMBER_RE = re.compile(r'\s+\d+\.?\d*')
+_ARTICLE_NUMBER_RE = re.compile(r'\s+(?:[IVXLCDM]+|\d+)')
+_SECTION_KEYWORDS = (
+    ("SECTION", _SECTION_NUMBER_RE),
+    ("Section", _SECTION_NUMBER_RE),
+    ("ARTICLE", _ARTICLE_NUMBER_RE),
+    ("Article", _ARTICLE_NUMBER_RE),
+)
+# Only the start of a chunk is searched for a heading
+SECTION_SCAN_CHARS = 500
+
+# Document type keywords in priority order; the highest-priority match wins
+DOCUMENT_TYPE_KEYWORDS = (
+    ("compliance certificate", "Compliance Certificate"),
+    ("credit agreement", "Credit Agreement"),
+    ("loan agreement", "Credit Agreement"),
+    ("credit application", "Credit Application"),
+    ("lsta", "LSTA Agreement"),
+)
+
+_DOCUMENT_TYPES = {
+    keyword: (priority, label)
+    for priority, (keyword, label) in enumerate(DOCUMENT_TYPE_KEYWORDS)
+}
+
+if ahocorasick is not None:
+    # One automaton finds every keyword in a single pass over the text
+    _DOCUMENT_TYPE_AUTOMATON = ahocorasick.Automaton()
+    for _keyword, _match in _DOCUMENT_TYPES.items():
+        _DOCUMENT_TYPE_AUTOMATON.add_word(_keyword, _match)
+    _DOCUMENT_TYPE_AUTOMATON.make_automaton()
+
+# Case-insensitive alternation, so the fallback never builds a lowercased copy.
+# Each keyword is its own group: IGNORECASE also matches text (e.g. a dotted
+# capital I) that does not casefold back to the keyword, so matches are
+# identified by group number rather than by their text.
+_DOCUMENT_TYPE_RE = re.compile(
+    "|".join(f"({re.escape(keyword)})" for keyword, _ in DOCUMENT_TYPE_KEYWORDS),
+    re.IGNORECASE
+)
+
+
+def _mean_pool_normalize(hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """
+    Mean-pool token embeddings over the attention mask and L2-normalize.
+    
+    Args:
+        hidden: (batch, seq, dim) token embeddings
+        mask: (batch, seq) attention mask
+        
+    Returns:
+        (batch, dim) float32 sentence embeddings
+    """
+    if numba is not None:
+        out = np.empty((hidden.shape[0], hidden.shape[2]), dtype=np.float32)
+        _mean_pool_normalize_jit(
+            np.ascontiguousarray(hidden, dtype=np.float32),
+            np.ascontiguousarray(mask, dtype=np.int64),
+            out
+        )
+        return out
+    
+    mask = mask[..., None].astype(np.float32)
+    pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+    return (pooled / np.clip(norms, 1e-12, None)).astype(np.float32)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _mean_pool_normalize_jit(hidden, mask, out):
+        """Fused masked mean-pool + L2-normalize, one batch row per thread."""
+        batch, seq, dim = hidden.shape
+        for b in numba.prange(batch):
+            out[b, :] = 0.0
+            count = 0.0
+            for t in range(seq):
+                if mask[b, t]:
+                    count += 1.0
+                    for d in range(dim):
+                        out[b, d] += hidden[b, t, d]
+            
+            norm = 0.0
+            for d in range(dim):
+                out[b, d] /= max(count, 1e-9)
+                norm += out[b, d] * out[b, d]
+            norm = max(np.sqrt(norm), 1e-12)
+            for d in range(dim):
+                out[b, d] /= norm
+    
+    # Compile at import so the first query does not pay the JIT cost
+    _mean_pool_normalize(np.zeros((1, 1, 1), dtype=np.float32), np.ones((1, 1), dtype=np.int64))
+
+
+class ONNXEmbeddings(Embeddings):
+    """
+    Sentence-transformer embeddings served by an int8-quantized ONNX Runtime model.
+    
+    Produces the same normalized mean-pooled vectors as HuggingFaceEmbeddings,
+    but runs the encoder with dynamic int8 kernels. Inputs are sorted by token
+    length before batching so each batch is only padded to its own longest text.
+    """
+    
+    def __init__(
+        self,
+        model_name: str,
+        cache_dir: str = "./model_cache",
+        batch_size: int = 64,
+        max_length: int = 256,
+        num_threads: Optional[int] = None
+    ):
+        """
+        Export (once) and load the quantized ONNX model.
+        
+        Args:
+            model_name: HuggingFace sentence-transformer model name
+            cache_dir: Directory holding the exported, quantized model
+            batch_size: Number of texts per forward pass
+            max_length: Token truncation length (matches sentence-transformers)
+            num_threads: Intra-op threads for ONNX Runtime (default: all cores)
+        """
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+        
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        
+        quantized_dir = Path(cache_dir) / model_name.replace("/", "--")
+        if not (quantized_dir / "model_quantized.onnx").exists():
+            logger.info(f"Exporting {model_name} to ONNX with int8 quantization")
+            model = ORTModelForFeatureExtraction.from_pretrained(
+                model_name,
+                export=True,
+                provider="CPUExecutionProvider"
+            )
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(
+                save_dir=quantized_dir,
+                quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+            )
+        
+        session_options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+        
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            quantized_dir,
+            file_name="model_quantized.onnx",
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed a list of texts in length-sorted batches."""
+        if not texts:
+            return []
+        
+        encodings = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        order = np.argsort([len(ids) for ids in encodings["input_ids"]], kind="stable")
+        embeddings = np.empty((len(texts), self.model.config.hidden_size), dtype=np.float32)
+        
+        for start in range(0, len(texts), self.batch_size):
+            batch_idx = order[start:start + self.batch_size]
+            inputs = self.tokenizer.pad(
+                [{key: values[i] for key, values in encodings.items()} for i in batch_idx],
+                return_tensors="np"
+            )
+            hidden = self.model(**inputs).last_hidden_state
+            embeddings[batch_idx] = _mean_pool_normalize(hidden, inputs["attention_mask"])
+        
+        return embeddings.tolist()
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query text."""
+        return self.embed_documents([text])[0]
+
+
+def select_device() -> str:
+    """
+    Pick the fastest available torch device for the embedding model.
+    
+    Returns:
+        "cuda", "mps" or "cpu"
+    """
+    try:
+        import torch
+    except ImportError:
+        return "cpu"
+    
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def create_embeddings(
+    model_name: str,
+    use_onnx: bool = True,
+    device: str = "cpu",
+    num_threads: Optional[int] = None
+) -> Embeddings:
+    """
+    Create the embedding model for the given device.
+    
+    On CPU the quantized ONNX encoder is preferred. On a GPU or Apple
+    Silicon the sentence-transformer runs in half precision with larger
+    batches instead.
+    
+    Args:
+        model_name: HuggingFace sentence-transformer model name
+        use_onnx: Use ONNX Runtime on CPU when optimum is installed
+        device: Torch device, see select_device()
+        num_threads: CPU compute threads for the model (default: all cores)
+        
+    Returns:
+        Embeddings instance producing normalized vectors
+    """
+    if use_onnx and device == "cpu":
+        try:
+            return ONNXEmbeddings(model_name, num_threads=num_threads)
+        except ImportError:
+            logger.warning("optimum[onnxruntime] not installed, falling back to sentence-transformers")
+    
+    if num_threads is not None:
+        import torch
+        torch.set_num_threads(num_threads)
+    
+    embeddings = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': device},
+        encode_kwargs={
+            'batch_size': 32 if device == "cpu" else 128,
+            'normalize_embeddings': True
+        }
+    )
+    if device != "cpu":
+        embeddings.client.half()
+    return embeddings
+
+
+# Model instance owned by an embedding worker process
+_worker_embeddings = None
+
+
+def _init_embedding_worker(model_name: str, use_onnx: bool):
+    """Load the embedding model once per worker process."""
+    global _worker_embeddings
+    # Parallelism comes from the worker processes; a model using every core
+    # in every worker would oversubscribe the CPU
+    _worker_embeddings = create_embeddings(model_name, use_onnx, num_threads=1)
+
+
+def _embed_shard(texts: List[str]) -> np.ndarray:
+    """Embed one shard of texts in a worker process."""
+    return np.asarray(_worker_embeddings.embed_documents(texts), dtype=np.float32)
+
+
+def _scan_documents(directory: Path) -> List[Tuple[Path, int, int]]:
+    """
+    Recursively list loadable documents under a directory.
+    
+    Args:
+        directory: Root directory to scan
+        
+    Returns:
+        Sorted (path, mtime_ns, size) tuples for every PDF and Word file
+    """
+    found = []
+    pending = [directory] if directory.is_dir() else []
+    
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(Path(entry.path))
+                elif entry.name.endswith(DOCUMENT_SUFFIXES):
+                    stat = entry.stat()
+                    found.append((Path(entry.path), stat.st_mtime_ns, stat.st_size))
+    
+    return sorted(found)
+
+
+def _load_file(path: Path) -> List[Document]:
+    """Load a single PDF or Word document into per-page documents."""
+    loader_cls = PyPDFLoader if path.suffix == ".pdf" else Docx2txtLoader
+    try:
+        return loader_cls(str(path)).load()
+    except Exception as e:
+        logger.error(f"Error loading {path}: {e}")
+        return []
+
+
+class DocumentCache:
+    """
+    SQLite-backed cache of chunk embeddings, parsed pages and chunk spans.
+    
+    Embeddings are keyed by a hash of the embedding namespace and chunk text,
+    so unchanged chunks are never re-embedded. Parsed pages and the chunk
+    spans the text splitter produced for them are keyed by file path,
+    modification time and size, so unchanged files skip parsing and splitting.
+    """
+    
+    # SQLite limits the number of bound parameters per statement
+    _QUERY_BATCH = 500
+    
+    def __init__(self, path: Path, namespace: str):
+        """
+        Open (or create) the cache database.
+        
+        Args:
+            path: SQLite database file
+            namespace: Identifies the embedding model that produced cached vectors
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.namespace = namespace.encode()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                documents TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunk_spans (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                spans TEXT NOT NULL
+            );
+            """
+        )
+    
+    def content_key(self, text: str) -> str:
+        """Return the cache key for a chunk's text."""
+        hasher = hashlib.blake2b(self.namespace, digest_size=16)
+        hasher.update(b"\0")
+        hasher.update(text.encode())
+        return hasher.hexdigest()
+    
+    def get_vectors(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Return cached vectors for whichever of the keys are present."""
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self._QUERY_BATCH):
+                batch = keys[start:start + self._QUERY_BATCH]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+    
+    def put_vectors(self, keys: List[str], vectors: np.ndarray):
+        """Store vectors under their content keys."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                ((key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in zip(keys, vectors))
+            )
+    
+    def has_pages(self, path: Path, mtime_ns: int, size: int) -> bool:
+        """Return whether the parsed pages of an unchanged file are cached."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM pages WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (str(path), mtime_ns, size)
+            ).fetchone()
+        return row is not None
+    
+    def get_pages(self, path: Path, mtime_ns: int, size: int) -> Optional[List[Document]]:
+        """Return the parsed pages of a file if it is unchanged since it was cached."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT documents FROM pages WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (str(path), mtime_ns, size)
+            ).fetchone()
+        if row is None:
+            return None
+        return [
+            Document(page_content=content, metadata=metadata)
+            for content, metadata in json.loads(row[0])
+        ]
+    
+    def put_pages(self, path: Path, mtime_ns: int, size: int, documents: List[Document]):
+        """Store the parsed pages of a file."""
+        payload = json.dumps([[doc.page_content, doc.metadata] for doc in documents])
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pages (path, mtime_ns, size, documents) VALUES (?, ?, ?, ?)",
+                (str(path), mtime_ns, size, payload)
+            )
+    
+    def get_chunk_spans(self, path: Path, mtime_ns: int, size: int) -> Optional[List[List[list]]]:
+        """Return the (start, end, section) chunk spans of each page of an unchanged file."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT spans FROM chunk_spans WHERE path = ? AND mtime_ns = ? AND size = ?",
+                (str(path), mtime_ns, size)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+    
+    def put_chunk_spans(self, path: Path, mtime_ns: int, size: int, spans: List[List[tuple]]):
+        """Store the chunk spans of each page of a file."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO chunk_spans (path, mtime_ns, size, spans) VALUES (?, ?, ?, ?)",
+                (str(path), mtime_ns, size, json.dumps(spans))
+            )
+    
+    def prune(self, files: List[Tuple[Path, int, int]], keys: List[str]) -> int:
+        """
+        Drop entries the current corpus no longer uses.
+        
+        Args:
+            files: (path, mtime_ns, size) of every current document
+            keys: Content keys of every current chunk
+            
+        Returns:
+            Number of rows deleted
+        """
+        with self._lock, self._connection:
+            connection = self._connection
+            connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS live_files "
+                "(path TEXT, mtime_ns INTEGER, size INTEGER, PRIMARY KEY (path, mtime_ns, size))"
+            )
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS live_keys (key TEXT PRIMARY KEY)")
+            connection.execute("DELETE FROM live_files")
+            connection.execute("DELETE FROM live_keys")
+            connection.executemany(
+                "INSERT OR IGNORE INTO live_files VALUES (?, ?, ?)",
+                ((str(path), mtime_ns, size) for path, mtime_ns, size in files)
+            )
+            connection.executemany("INSERT OR IGNORE INTO live_keys VALUES (?)", ((key,) for key in keys))
+            
+            deleted = 0
+            for table in ("pages", "chunk_spans"):
+                deleted += connection.execute(
+                    f"DELETE FROM {table} WHERE (path, mtime_ns, size) NOT IN "
+                    "(SELECT path, mtime_ns, size FROM live_files)"
+                ).rowcount
+            deleted += connection.execute(
+                "DELETE FROM embeddings WHERE key NOT IN (SELECT key FROM live_keys)"
+            ).rowcount
+        return deleted
+
+
+class RerankingFAISS(FAISS):
+    """
+    FAISS store whose MMR search re-scores candidates with exact vectors.
+    
+    The compressed index only shortlists `fetch_k` candidates. Their full
+    precision embeddings are then read from the DocumentCache, so MMR diversity
+    and the returned scores come from fp32 vectors rather than PQ reconstructions.
+    """
+    
+    def __init__(self, *args: Any, cache: DocumentCache, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+    
+    def max_marginal_relevance_search_with_score_by_vector(
+        self,
+        embedding: List[float],
+        *,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[Document, float]]:
+        """Select documents by MMR over exact vectors of the shortlisted candidates."""
+        if filter is not None:
+            return super().max_marginal_relevance_search_with_score_by_vector(
+                embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter
+            )
+        
+        query = np.asarray(embedding, dtype=np.float32)
+        _, indices = self.index.search(query[None, :], fetch_k)
+        # -1 happens when fewer than fetch_k documents are indexed
+        docs = [self.docstore.search(self.index_to_docstore_id[i]) for i in indices[0] if i != -1]
+        if not docs:
+            return []
+        
+        keys = [self.cache.content_key(doc.page_content) for doc in docs]
+        vectors = self.cache.get_vectors(keys)
+        missing = {key: doc.page_content for key, doc in zip(keys, docs) if key not in vectors}
+        if missing:
+            embedded = self._embed_documents(list(missing.values()))
+            vectors.update(zip(missing, np.asarray(embedded, dtype=np.float32)))
+        candidates = np.stack([vectors[key] for key in keys])
+        
+        scores = candidates @ query
+        selected = maximal_marginal_relevance(query, candidates, lambda_mult=lambda_mult, k=k)
+        return [(docs[i], float(scores[i])) for i in selected]
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent query embeddings into a single forward pass.
+    
+    Questions submitted within `max_wait_ms` of the first one in a batch (up
+    to `max_batch` of them) are embedded with one embed_documents call, and
+    each caller receives its own vector.
+    """
+    
+    def __init__(self, embeddings: Embeddings, max_batch: int = 32, max_wait_ms: float = 20):
+        """
+        Args:
+            embeddings: Model used to embed the batched questions
+            max_batch: Maximum number of questions per forward pass
+            max_wait_ms: How long the first question waits for company
+        """
+        self.embeddings = embeddings
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+    
+    async def embed(self, text: str) -> List[float]:
+        """Embed one question, sharing the forward pass with concurrent callers."""
+        loop = asyncio.get_running_loop()
+        
+        # (Re)start the background task on first use or under a new event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        
+        future = loop.create_future()
+        await self._queue.put((text, future))
+        return await future
+    
+    async def _run(self):
+        """Collect pending questions into batches and embed them."""
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            try:
+                vectors = await loop.run_in_executor(
+                    None,
+                    self.embeddings.embed_documents,
+                    [text for text, _ in batch]
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
 
 class CreditAgreementChatbot:
     """
@@ -40,7 +659,11 @@ class CreditAgreementChatbot:
         vector_store_path: str = "./vector_store",
         model_name: str = "gpt-3.5-turbo",
         embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
-        refresh_interval: int = 3600  # 1 hour in seconds
+        refresh_interval: int = 3600,  # 1 hour in seconds
+        nprobe: int = 16,
+        use_onnx: bool = True,
+        num_workers: int = 1,
+        streaming: bool = False
     ):
         """
         Initialize the Credit Agreement Chatbot.
@@ -51,19 +674,35 @@ class CreditAgreementChatbot:
             model_name: OpenAI model name for the LLM
             embedding_model: HuggingFace embedding model name
             refresh_interval: Time in seconds between document refresh (default 1 hour)
+            nprobe: Number of inverted lists scanned per query on the IVFPQ index
+            use_onnx: Run the embedding model with int8 ONNX Runtime when available
+            num_workers: Worker processes used to parse and embed documents during refresh.
+                Values above 1 spawn processes, so the calling script must be
+                guarded by `if __name__ == "__main__"`.
+            streaming: Stream answer tokens to stdout as they are generated. Leave
+                off for batch or scripted use, which reads each answer in one response.
         """
         self.documents_directory = Path(documents_directory)
         self.vector_store_path = Path(vector_store_path)
         self.model_name = model_name
         self.refresh_interval = refresh_interval
+        self.nprobe = nprobe
+        self.embedding_model = embedding_model
+        self.use_onnx = use_onnx
+        self.num_workers = num_workers
+        # Monotonic clock for interval checks; wall clock only for logging
         self.last_refresh = None
+        self.last_refresh_wall = None
         
-        # Initialize embeddings
-        logger.info(f"Loading embedding model: {embedding_model}")
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name=embedding_model,
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
+        # Initialize embeddings on the best available device
+        self.device = select_device()
+        logger.info(f"Loading embedding model: {embedding_model} on {self.device}")
+        self.embeddings = create_embeddings(embedding_model, use_onnx, self.device)
+        
+        # Cache of chunk embeddings and parsed pages, kept next to the vector store
+        self.cache = DocumentCache(
+            self.vector_store_path / "cache.sqlite",
+            f"{embedding_model}/{type(self.embeddings).__name__}"
         )
         
         # Initialize text splitter with credit-specific configuration
@@ -71,6 +710,7 @@ class CreditAgreementChatbot:
             chunk_size=1200,
             chunk_overlap=200,
             length_function=len,
+            add_start_index=True,  # Lets chunk spans be cached per file
             separators=[
                 "\n\n",  # Paragraph breaks
                 "\n",    # Line breaks
@@ -88,28 +728,36 @@ class CreditAgreementChatbot:
         self.llm = ChatOpenAI(
             model_name=model_name,
             temperature=0,  # Deterministic responses for financial analysis
-            streaming=True,
-            callbacks=[StreamingStdOutCallbackHandler()]
+            streaming=streaming,
+            callbacks=[StreamingStdOutCallbackHandler()] if streaming else None
         )
         
         # Initialize vector store
         self.vector_store = None
         self.qa_chain = None
+        # Guards in-place index swaps against concurrent retrieval
+        self._index_lock = threading.Lock()
+        # Serializes refreshes, which share the on-disk store and worker pool
+        self._refresh_lock = threading.Lock()
+        # Embedding worker pool, only alive for the duration of a refresh
+        self._embedding_pool = None
+        # Shares query embedding forward passes between concurrent aquery() calls
+        self._batcher = EmbeddingBatcher(self.embeddings)
         
         # Load or create initial vector store
         self._initialize_vector_store()
         
     def _initialize_vector_store(self):
         """Initialize or load existing vector store."""
-        if self.vector_store_path.exists() and (self.vector_store_path / "index.faiss").exists():
+        if (
+            (self.vector_store_path / "index.faiss").exists()
+            and (self.vector_store_path / "docs.mp").exists()
+        ):
             logger.info("Loading existing vector store...")
             try:
-                self.vector_store = FAISS.load_local(
-                    str(self.vector_store_path),
-                    self.embeddings,
-                    allow_dangerous_deserialization=True
-                )
-                self.last_refresh = datetime.now()
+                self.vector_store = self._load_vector_store()
+                self.last_refresh = time.monotonic()
+                self.last_refresh_wall = datetime.now()
                 logger.info("Vector store loaded successfully")
             except Exception as e:
                 logger.error(f"Error loading vector store: {e}")
@@ -122,93 +770,244 @@ class CreditAgreementChatbot:
         # Initialize QA chain
         self._initialize_qa_chain()
     
-    def _load_documents(self) -> List[Document]:
+    def _load_vector_store(self) -> RerankingFAISS:
         """
-        Load all documents from the directory.
+        Load the persisted FAISS index and docstore.
+        
+        The index is memory-mapped read-only where FAISS supports it, so it is
+        paged in on demand rather than copied into memory at startup.
         
         Returns:
-            List of loaded documents with metadata
+            Vector store wrapping the loaded index
         """
-        logger.info(f"Loading documents from {self.documents_directory}")
-        documents = []
-        
-        # Load PDFs
-        pdf_loader = DirectoryLoader(
-            str(self.documents_directory),
-            glob="**/*.pdf",
-            loader_cls=PyPDFLoader,
-            show_progress=True,
-            use_multithreading=True
-        )
+        index_path = str(self.vector_store_path / "index.faiss")
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Not every index type can be memory-mapped
+            index = faiss.read_index(index_path)
+        
+        with open(self.vector_store_path / "docs.mp", "rb") as f:
+            payload = msgpack.unpack(f, raw=False)
         
-        # Load Word documents
-        docx_loader = DirectoryLoader(
-            str(self.documents_directory),
-            glob="**/*.docx",
-            loader_cls=Docx2txtLoader,
-            show_progress=True
+        ids = [doc_id for doc_id, _, _ in payload["docs"]]
+        return RerankingFAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore({
+                doc_id: Document(page_content=content, metadata=metadata)
+                for doc_id, content, metadata in payload["docs"]
+            }),
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            cache=self.cache
         )
+    
+    def _save_vector_store(self, store: FAISS):
+        """
+        Persist a vector store as a raw FAISS index plus a msgpack docstore.
         
-        try:
-            pdf_docs = pdf_loader.load()
-            docx_docs = docx_loader.load()
-            documents.extend(pdf_docs)
-            documents.extend(docx_docs)
+        Files are written under temporary names and renamed into place, so a
+        memory-mapped index from an earlier load is never overwritten.
+        
+        Args:
+            store: Vector store to save
+        """
+        self.vector_store_path.mkdir(parents=True, exist_ok=True)
+        index_path = self.vector_store_path / "index.faiss"
+        docs_path = self.vector_store_path / "docs.mp"
+        
+        # Documents are written in index row order
+        doc_ids = [store.index_to_docstore_id[i] for i in range(store.index.ntotal)]
+        documents = [store.docstore.search(doc_id) for doc_id in doc_ids]
+        
+        faiss.write_index(store.index, f"{index_path}.tmp")
+        with open(f"{docs_path}.tmp", "wb") as f:
+            msgpack.pack({
+                "docs": [
+                    (doc_id, doc.page_content, doc.metadata)
+                    for doc_id, doc in zip(doc_ids, documents)
+                ]
+            }, f)
+        
+        os.replace(f"{index_path}.tmp", index_path)
+        os.replace(f"{docs_path}.tmp", docs_path)
+    
+    def _iter_documents(self) -> Iterator[Tuple[Tuple[Path, int, int], List[Document]]]:
+        """
+        Stream the documents in the directory one file at a time.
+        
+        Unchanged files are served from the page cache; the rest are parsed
+        and written back to it.
+        
+        Yields:
+            ((path, mtime_ns, size), per-page documents) for each file
+        """
+        files = _scan_documents(self.documents_directory)
+        # Hit or miss is decided once per file; parsed pages carry their path,
+        # so they can never be stored under another file's key
+        misses = {
+            path for path, mtime_ns, size in files
+            if not self.cache.has_pages(path, mtime_ns, size)
+        }
+        logger.info(f"Reused parsed pages for {len(files) - len(misses)} of {len(files)} files")
+        
+        parsed = self._parse_files([path for path, _, _ in files if path in misses])
+        for path, mtime_ns, size in files:
+            docs = None if path in misses else self.cache.get_pages(path, mtime_ns, size)
+            if docs is None:
+                if path in misses:
+                    parsed_path, docs = next(parsed)
+                    assert parsed_path == path
+                else:
+                    # Evicted since the hit/miss scan; parse it inline
+                    docs = _load_file(path)
+                if docs:
+                    self.cache.put_pages(path, mtime_ns, size, docs)
             
             # Enhance metadata
-            for doc in documents:
+            for doc in docs:
                 if 'source' in doc.metadata:
                     doc.metadata['filename'] = Path(doc.metadata['source']).name
                     doc.metadata['file_type'] = Path(doc.metadata['source']).suffix
-                    
-            logger.info(f"Loaded {len(documents)} documents")
-            return documents
             
-        except Exception as e:
-            logger.error(f"Error loading documents: {e}")
-            return []
+            yield (path, mtime_ns, size), docs
     
-    def _preprocess_documents(self, documents: List[Document]) -> List[Document]:
+    def _parse_files(self, paths: List[Path]) -> Iterator[Tuple[Path, List[Document]]]:
+        """
+        Parse files into per-page documents, in a process pool when configured.
+        
+        Only a few files are parsed ahead of the consumer, so parsed pages never
+        pile up in memory while earlier files are still being embedded.
+        
+        Args:
+            paths: Files to parse
+            
+        Yields:
+            (path, parsed pages) for each path, in input order
+        """
+        workers = min(self.num_workers, len(paths))
+        
+        if workers <= 1:
+            for path in paths:
+                yield path, _load_file(path)
+            return
+        
+        logger.info(f"Parsing {len(paths)} files across {workers} processes")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            pending = deque()
+            for path in paths:
+                pending.append((path, executor.submit(_load_file, path)))
+                if len(pending) > 2 * workers:
+                    done_path, future = pending.popleft()
+                    yield done_path, future.result()
+            while pending:
+                done_path, future = pending.popleft()
+                yield done_path, future.result()
+    
+    def _iter_chunks(self) -> Iterator[Document]:
+        """
+        Stream chunked documents, holding only one file's pages at a time.
+        
+        Boilerplate repeated across amendments and restatements is yielded
+        once; later copies are recorded in the first chunk's `also_in`
+        metadata so every location stays citable.
+        
+        Yields:
+            Unique chunked documents with enhanced metadata
+        """
+        seen: Dict[bytes, Document] = {}
+        duplicates = 0
+        
+        for file_key, documents in self._iter_documents():
+            for chunk in self._preprocess_documents(documents, file_key):
+                key = hashlib.blake2b(chunk.page_content.encode(), digest_size=16).digest()
+                original = seen.get(key)
+                if original is None:
+                    seen[key] = chunk
+                    yield chunk
+                else:
+                    duplicates += 1
+                    original.metadata.setdefault('also_in', []).append({
+                        "filename": chunk.metadata.get("filename", "Unknown"),
+                        "page": chunk.metadata.get("page", "N/A"),
+                        "section": chunk.metadata.get("section", "N/A")
+                    })
+        
+        logger.info(f"Merged {duplicates} duplicate chunks into {len(seen)} unique chunks")
+    
+    def _preprocess_documents(
+        self,
+        documents: List[Document],
+        file_key: Optional[Tuple[Path, int, int]] = None
+    ) -> List[Document]:
         """
         Preprocess and chunk documents for optimal retrieval.
         
         Args:
-            documents: List of raw documents
+            documents: List of raw documents (the pages of one file)
+            file_key: (path, mtime_ns, size) of the source file; when given, the
+                chunk spans are cached so an unchanged file skips the splitter
             
         Returns:
             List of chunked documents with enhanced metadata
         """
-        logger.info("Preprocessing and chunking documents...")
+        spans = self.cache.get_chunk_spans(*file_key) if file_key else None
+        if spans is not None and len(spans) != len(documents):
+            spans = None
+        new_spans = []
         
         processed_docs = []
         
-        for doc in documents:
+        for page, doc in enumerate(documents):
             # Clean the text
             text = doc.page_content
             
-            # Add document-level metadata to help with citations
-            filename = doc.metadata.get('filename', 'Unknown')
-            
             # Identify document type based on content
             doc_type = self._identify_document_type(text)
             doc.metadata['document_type'] = doc_type
             
-            # Split into chunks
-            chunks = self.text_splitter.split_documents([doc])
-            
-            # Enhance chunk metadata
-            for i, chunk in enumerate(chunks):
-                chunk.metadata['chunk_id'] = i
-                chunk.metadata['total_chunks'] = len(chunks)
-                
-                # Try to identify section information
-                section_info = self._extract_section_info(chunk.page_content)
-                if section_info:
-                    chunk.metadata['section'] = section_info
-                    
-                processed_docs.append(chunk)
-        
-        logger.info(f"Created {len(processed_docs)} chunks from {len(documents)} documents")
+            if spans is None:
+                # Split into chunks
+                chunks = self.text_splitter.split_documents([doc])
+                texts = [chunk.page_content for chunk in chunks]
+                starts = [chunk.metadata['start_index'] for chunk in chunks]
+                sections = list(map(self._extract_section_info, texts))
+                new_spans.append([
+                    (start, start + len(chunk_text), section)
+                    for start, chunk_text, section in zip(starts, texts, sections)
+                ])
+            else:
+                # Slice the cached spans straight out of the page text
+                starts = [start for start, _, _ in spans[page]]
+                texts = [text[start:end] for start, end, _ in spans[page]]
+                sections = [section for _, _, section in spans[page]]
+            
+            # Materialize the enriched chunks from the parallel lists in one pass
+            total_chunks = len(texts)
+            processed_docs.extend(
+                Document(
+                    page_content=chunk_text,
+                    metadata={
+                        **doc.metadata,
+                        'start_index': start,
+                        'chunk_id': i,
+                        'total_chunks': total_chunks,
+                        **({'section': section} if section else {}),
+                    }
+                )
+                for i, (chunk_text, start, section) in enumerate(zip(texts, starts, sections))
+            )
+        
+        # Spans are only reusable if the splitter located every chunk in its page
+        if file_key and new_spans and all(
+            start >= 0 for page_spans in new_spans for start, _, _ in page_spans
+        ):
+            self.cache.put_chunk_spans(*file_key, new_spans)
+        
         return processed_docs
     
     def _identify_document_type(self, text: str) -> str:
@@ -221,18 +1020,22 @@ class CreditAgreementChatbot:
         Returns:
             Document type string
         """
-        text_lower = text.lower()
-        
-        if 'compliance certificate' in text_lower:
-            return 'Compliance Certificate'
-        elif 'credit agreement' in text_lower or 'loan agreement' in text_lower:
-            return 'Credit Agreement'
-        elif 'credit application' in text_lower:
-            return 'Credit Application'
-        elif 'lsta' in text_lower:
-            return 'LSTA Agreement'
+        if ahocorasick is not None:
+            matches = (match for _, match in _DOCUMENT_TYPE_AUTOMATON.iter(text.lower()))
         else:
-            return 'Credit Document'
+            matches = (
+                (found.lastindex - 1, DOCUMENT_TYPE_KEYWORDS[found.lastindex - 1][1])
+                for found in _DOCUMENT_TYPE_RE.finditer(text)
+            )
+        
+        best = None
+        for priority, label in matches:
+            if best is None or priority < best[0]:
+                best = (priority, label)
+                if priority == 0:
+                    break
+        
+        return best[1] if best else 'Credit Document'
     
     def _extract_section_info(self, text: str) -> Optional[str]:
         """
@@ -244,20 +1047,13 @@ class CreditAgreementChatbot:
         Returns:
             Section identifier or None
         """
-        import re
-        
-        # Look for common section patterns
-        patterns = [
-            r'SECTION\s+(\d+\.?\d*)',
-            r'Section\s+(\d+\.?\d*)',
-            r'ARTICLE\s+([IVXLCDM]+|\d+)',
-            r'Article\s+([IVXLCDM]+|\d+)',
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, text[:500])  # Check first 500 chars
-            if match:
-                return match.group(0)
+        for keyword, number_re in _SECTION_KEYWORDS:
+            start = text.find(keyword, 0, SECTION_SCAN_CHARS)
+            while start != -1:
+                match = number_re.match(text, start + len(keyword), SECTION_SCAN_CHARS)
+                if match:
+                    return text[start:match.end()]
+                start = text.find(keyword, start + 1, SECTION_SCAN_CHARS)
         
         return None
     
@@ -265,43 +1061,274 @@ class CreditAgreementChatbot:
         """Refresh the vector store with current documents."""
         logger.info("Refreshing document index...")
         
-        # Load documents
-        documents = self._load_documents()
+        # Skip the whole pipeline when no document was added, removed or modified
+        fingerprint = self._fingerprint_documents()
+        fingerprint_path = self.vector_store_path / "fingerprint.txt"
+        if (
+            self.vector_store is not None
+            and fingerprint_path.exists()
+            and fingerprint_path.read_text() == fingerprint
+        ):
+            self.last_refresh = time.monotonic()
+            self.last_refresh_wall = datetime.now()
+            logger.info("No document changes since last refresh")
+            return
+        
+        # Stream chunks file by file and embed them in fixed-size buffers, so
+        # raw pages never accumulate. Index training needs the full sample, so
+        # only the compact float32 vectors are kept until the end.
+        logger.info(f"Loading documents from {self.documents_directory}")
+        processed_docs = []
+        vector_batches = []
+        buffer = []
+        try:
+            for chunk in self._iter_chunks():
+                buffer.append(chunk)
+                if len(buffer) >= EMBEDDING_BUFFER_SIZE:
+                    vector_batches.append(self._embed_with_cache([doc.page_content for doc in buffer]))
+                    processed_docs.extend(buffer)
+                    buffer = []
+            if buffer:
+                vector_batches.append(self._embed_with_cache([doc.page_content for doc in buffer]))
+                processed_docs.extend(buffer)
+        finally:
+            if self._embedding_pool is not None:
+                self._embedding_pool.shutdown()
+                self._embedding_pool = None
         
-        if not documents:
+        if not processed_docs:
             logger.warning("No documents found to index")
             return
         
-        # Preprocess documents
-        processed_docs = self._preprocess_documents(documents)
+        # Build a compressed index over the embedded chunks
+        logger.info(f"Creating vector store from {len(processed_docs)} chunks...")
+        index = self._build_index(np.concatenate(vector_batches))
         
-        # Create new vector store
-        logger.info("Creating vector store...")
-        self.vector_store = FAISS.from_documents(
-            processed_docs,
-            self.embeddings
+        ids = [str(uuid.uuid4()) for _ in processed_docs]
+        new_store = RerankingFAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore(dict(zip(ids, processed_docs))),
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            cache=self.cache
         )
         
         # Save vector store
+        self._save_vector_store(new_store)
+        fingerprint_path.write_text(fingerprint)
+        
+        # Forget vectors of edited chunks and parses of changed or deleted files
+        deleted = self.cache.prune(
+            _scan_documents(self.documents_directory),
+            [self.cache.content_key(doc.page_content) for doc in processed_docs]
+        )
+        logger.info(f"Pruned {deleted} stale cache entries")
+        
+        # Swap the new index into the existing store so the QA chain's
+        # retriever keeps working without being rebuilt
+        with self._index_lock:
+            if self.vector_store is None:
+                self.vector_store = new_store
+            else:
+                self.vector_store.index = new_store.index
+                self.vector_store.docstore = new_store.docstore
+                self.vector_store.index_to_docstore_id = new_store.index_to_docstore_id
+        
+        self.last_refresh = time.monotonic()
+        self.last_refresh_wall = datetime.now()
+        logger.info(f"Vector store refreshed at {self.last_refresh_wall}")
+    
+    def _fingerprint_documents(self) -> str:
+        """
+        Hash the path, modification time and size of every document.
+        
+        The embedding namespace and index layout are hashed too, since an index
+        built by another model or layout is stale even if no document changed.
+        
+        Returns:
+            Hex digest that changes whenever a document is added, removed or
+            modified, or the embedding model or index layout changes
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(self.cache.namespace + b"\0")
+        hasher.update(f"{IVF_LISTS}\0{PQ_SUBQUANTIZERS}\0{PQ_BITS}\0{MIN_TRAINING_POINTS}\n".encode())
+        for path, mtime_ns, size in _scan_documents(self.documents_directory):
+            hasher.update(f"{path}\0{mtime_ns}\0{size}\n".encode())
+        return hasher.hexdigest()
+    
+    def _embed_with_cache(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts, reusing cached vectors for chunks seen in earlier refreshes.
+        
+        Args:
+            texts: Chunk texts to embed
+            
+        Returns:
+            (N, d) float32 array of embeddings in input order
+        """
+        keys = [self.cache.content_key(text) for text in texts]
+        vectors = self.cache.get_vectors(keys)
+        
+        # Embed each missing text once, even if it appears in several chunks
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        logger.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        
+        if missing:
+            new_vectors = self._embed_texts(list(missing.values()))
+            self.cache.put_vectors(list(missing), new_vectors)
+            vectors.update(zip(missing, new_vectors))
+        
+        return np.stack([vectors[key] for key in keys])
+    
+    def _embed_texts(self, texts: List[str]) -> np.ndarray:
+        """
+        Embed texts, sharding them across worker processes for large batches.
+        
+        Args:
+            texts: Chunk texts to embed
+            
+        Returns:
+            (N, d) float32 array of embeddings in input order
+        """
+        workers = min(self.num_workers, len(texts) // MIN_TEXTS_PER_WORKER)
+        
+        # A single accelerator already outruns a pool of CPU workers
+        if workers <= 1 or self.device != "cpu":
+            return np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        
+        # Loaded models are not fork-safe, so workers are spawned fresh and
+        # keep their model for the rest of the refresh
+        if self._embedding_pool is None:
+            # A buffer never splits into more shards than this, so extra workers
+            # would only load a model and sit idle
+            pool_size = min(self.num_workers, EMBEDDING_BUFFER_SIZE // MIN_TEXTS_PER_WORKER)
+            logger.info(f"Starting {pool_size} embedding processes")
+            self._embedding_pool = ProcessPoolExecutor(
+                max_workers=pool_size,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_embedding_worker,
+                initargs=(self.embedding_model, self.use_onnx)
+            )
+        
+        bounds = np.linspace(0, len(texts), workers + 1, dtype=int)
+        shards = [texts[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+        return np.concatenate(list(self._embedding_pool.map(_embed_shard, shards)))
+    
+    def _build_index(self, vectors: np.ndarray) -> faiss.Index:
+        """
+        Build an inner-product FAISS index over normalized embeddings.
+        
+        Large corpora get an OPQ-rotated IVFPQ index, which stores compact PQ
+        codes and only scans `nprobe` inverted lists per query. Corpora too small to
+        train the quantizers fall back to an exact flat index.
+        
+        Training is the expensive step, so the trained, empty index is kept next
+        to the store and refreshes only add vectors to a copy of it, until the
+        corpus grows by RETRAIN_GROWTH over the one it was trained on. Training
+        itself only sees a random sample of at most TRAINING_SAMPLE_SIZE vectors.
+        
+        Args:
+            vectors: (N, d) float32 array of chunk embeddings
+            
+        Returns:
+            Trained FAISS index containing all vectors
+        """
+        dimension = vectors.shape[1]
+        
+        if len(vectors) < MIN_TRAINING_POINTS:
+            logger.info(f"Building flat index for {len(vectors)} vectors")
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = self._load_trained_index(dimension, len(vectors))
+            if index is None:
+                sample = vectors
+                if len(vectors) > TRAINING_SAMPLE_SIZE:
+                    rows = np.random.default_rng(0).choice(len(vectors), TRAINING_SAMPLE_SIZE, replace=False)
+                    sample = vectors[np.sort(rows)]
+                logger.info(f"Training OPQ+IVFPQ index on {len(sample)} of {len(vectors)} vectors")
+                # OPQ rotates vectors so PQ sub-spaces carry comparable variance
+                index = faiss.index_factory(
+                    dimension,
+                    f"OPQ{PQ_SUBQUANTIZERS}_{dimension},IVF{IVF_LISTS},PQ{PQ_SUBQUANTIZERS}x{PQ_BITS}",
+                    faiss.METRIC_INNER_PRODUCT
+                )
+                index.train(sample)
+                self._save_trained_index(index, len(vectors))
+            faiss.extract_index_ivf(index).nprobe = self.nprobe
+        
+        index.add(vectors)
+        return index
+    
+    def _load_trained_index(self, dimension: int, num_vectors: int) -> Optional[faiss.Index]:
+        """
+        Load the saved trained, empty index if it still suits the corpus.
+        
+        Args:
+            dimension: Embedding dimension of the corpus
+            num_vectors: Number of vectors about to be indexed
+            
+        Returns:
+            Empty trained index, or None if the quantizers need retraining
+        """
+        index_path = self.vector_store_path / "trained.faiss"
+        meta_path = self.vector_store_path / "trained.json"
+        if not (index_path.exists() and meta_path.exists()):
+            return None
+        
+        meta = json.loads(meta_path.read_text())
+        if (
+            meta["namespace"] != self.cache.namespace.decode()
+            or meta["dimension"] != dimension
+            or num_vectors > RETRAIN_GROWTH * meta["num_trained"]
+        ):
+            return None
+        
+        try:
+            index = faiss.read_index(str(index_path))
+        except RuntimeError as e:
+            logger.warning(f"Could not read trained index, retraining: {e}")
+            return None
+        
+        logger.info(f"Reusing quantizers trained on {meta['num_trained']} vectors")
+        return index
+    
+    def _save_trained_index(self, index: faiss.Index, num_trained: int):
+        """
+        Persist a trained index before any vectors are added to it.
+        
+        Args:
+            index: Trained, empty index
+            num_trained: Number of vectors it was trained on
+        """
         self.vector_store_path.mkdir(parents=True, exist_ok=True)
-        self.vector_store.save_local(str(self.vector_store_path))
+        index_path = self.vector_store_path / "trained.faiss"
         
-        self.last_refresh = datetime.now()
-        logger.info(f"Vector store refreshed at {self.last_refresh}")
+        faiss.write_index(index, f"{index_path}.tmp")
+        os.replace(f"{index_path}.tmp", index_path)
+        (self.vector_store_path / "trained.json").write_text(json.dumps({
+            "namespace": self.cache.namespace.decode(),
+            "dimension": index.d,
+            "num_trained": num_trained
+        }))
+    
+    def _refresh_due(self) -> bool:
+        """Return whether the refresh interval has elapsed (or no refresh ran yet)."""
+        return (
+            self.last_refresh is None
+            or time.monotonic() - self.last_refresh >= self.refresh_interval
+        )
     
     def _check_and_refresh(self):
         """Check if refresh is needed and perform it."""
-        if self.last_refresh is None:
-            self._refresh_documents()
+        if not self._refresh_due():
             return
         
-        time_since_refresh = (datetime.now() - self.last_refresh).total_seconds()
-        
-        if time_since_refresh >= self.refresh_interval:
-            logger.info("Refresh interval reached. Updating document index...")
-            self._refresh_documents()
-            # Reinitialize QA chain with new vector store
-            self._initialize_qa_chain()
+        with self._refresh_lock:
+            # Another caller may have refreshed while this one waited
+            if self._refresh_due():
+                logger.info("Refresh interval reached. Updating document index...")
+                self._refresh_documents()
     
     def _initialize_qa_chain(self):
         """Initialize the QA chain with custom prompt."""
@@ -334,13 +1361,19 @@ Provide a detailed answer with proper citations, confidence level, and formattin
             input_variables=["context", "question"]
         )
         
+        # The saved index keeps the nprobe it was built with; apply the configured one
+        ivf_index = faiss.try_extract_index_ivf(self.vector_store.index)
+        if ivf_index is not None:
+            ivf_index.nprobe = self.nprobe
+        
         # Create retrieval QA chain
         self.qa_chain = RetrievalQA.from_chain_type(
             llm=self.llm,
             chain_type="stuff",
             retriever=self.vector_store.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 6}  # Retrieve top 6 most relevant chunks
+                search_type="mmr",
+                # Shortlist 30 chunks, keep the 6 most relevant yet diverse ones
+                search_kwargs={"k": 6, "fetch_k": 30, "lambda_mult": 0.5}
             ),
             return_source_documents=True,
             chain_type_kwargs={"prompt": PROMPT}
@@ -364,39 +1397,114 @@ Provide a detailed answer with proper citations, confidence level, and formattin
         logger.info(f"Processing query: {question}")
         
         try:
-            result = self.qa_chain({"query": question})
-            
-            # Format the response
-            response = {
-                "answer": result["result"],
-                "sources": [
-                    {
-                        "filename": doc.metadata.get("filename", "Unknown"),
-                        "page": doc.metadata.get("page", "N/A"),
-                        "section": doc.metadata.get("section", "N/A"),
-                        "document_type": doc.metadata.get("document_type", "Unknown"),
-                        "content_preview": doc.page_content[:200] + "..."
-                    }
-                    for doc in result["source_documents"]
-                ],
-                "timestamp": datetime.now().isoformat()
-            }
+            # Embed outside the index lock; only the search itself must not
+            # see a concurrent refresh swap the index. The LLM call runs outside it too.
+            embedding = self.embeddings.embed_query(question)
+            source_documents = self._search_by_vector(embedding)
             
-            return response
+            answer = self.qa_chain.combine_documents_chain.run(
+                input_documents=source_documents,
+                question=question
+            )
+            
+            return self._format_response(answer, source_documents)
+            
+        except Exception as e:
+            return self._error_response(e)
+    
+    async def aquery(self, question: str) -> Dict[str, Any]:
+        """
+        Query the chatbot asynchronously.
+        
+        The question's embedding is batched with other concurrent aquery()
+        calls, so bursts of questions share a single forward pass.
+        
+        Args:
+            question: User's question about credit documents
+            
+        Returns:
+            Dictionary containing answer and source documents
+        """
+        loop = asyncio.get_running_loop()
+        
+        try:
+            # Check if refresh is needed
+            await loop.run_in_executor(None, self._check_and_refresh)
+            
+            logger.info(f"Processing query: {question}")
+            
+            embedding = await self._batcher.embed(question)
+            
+            # The FAISS search and cache reads block, so keep them off the event loop
+            source_documents = await loop.run_in_executor(None, self._search_by_vector, embedding)
+            
+            answer = await self.qa_chain.combine_documents_chain.arun(
+                input_documents=source_documents,
+                question=question
+            )
+            
+            return self._format_response(answer, source_documents)
             
         except Exception as e:
-            logger.error(f"Error processing query: {e}")
-            return {
-                "answer": f"I encountered an error processing your question: {str(e)}",
-                "sources": [],
-                "timestamp": datetime.now().isoformat()
-            }
+            return self._error_response(e)
+    
+    def _search_by_vector(self, embedding: List[float]) -> List[Document]:
+        """
+        Run the retriever's MMR search for a precomputed query embedding.
+        
+        Args:
+            embedding: Query embedding
+            
+        Returns:
+            Retrieved source documents
+        """
+        with self._index_lock:
+            return self.vector_store.max_marginal_relevance_search_by_vector(
+                embedding,
+                **self.qa_chain.retriever.search_kwargs
+            )
+    
+    def _format_response(self, answer: str, source_documents: List[Document]) -> Dict[str, Any]:
+        """
+        Format an answer and its source documents as a query response.
+        
+        Args:
+            answer: LLM answer text
+            source_documents: Chunks the answer was generated from
+            
+        Returns:
+            Dictionary containing answer and source documents
+        """
+        return {
+            "answer": answer,
+            "sources": [
+                {
+                    "filename": doc.metadata.get("filename", "Unknown"),
+                    "page": doc.metadata.get("page", "N/A"),
+                    "section": doc.metadata.get("section", "N/A"),
+                    "document_type": doc.metadata.get("document_type", "Unknown"),
+                    "content_preview": doc.page_content[:200] + "...",
+                    "also_in": doc.metadata.get("also_in", [])
+                }
+                for doc in source_documents
+            ],
+            "timestamp": datetime.now().isoformat()
+        }
+    
+    def _error_response(self, error: Exception) -> Dict[str, Any]:
+        """Build the response returned when a query fails."""
+        logger.error(f"Error processing query: {error}")
+        return {
+            "answer": f"I encountered an error processing your question: {str(error)}",
+            "sources": [],
+            "timestamp": datetime.now().isoformat()
+        }
     
     def manual_refresh(self):
         """Manually trigger a document refresh."""
         logger.info("Manual refresh triggered")
-        self._refresh_documents()
-        self._initialize_qa_chain()
+        with self._refresh_lock:
+            self._refresh_documents()
 
 
 def main():
@@ -411,7 +1519,9 @@ def main():
     print("Initializing Credit Agreement Chatbot...")
     chatbot = CreditAgreementChatbot(
         documents_directory=DOCUMENTS_DIR,
-        vector_store_path=VECTOR_STORE_PATH
+        vector_store_path=VECTOR_STORE_PATH,
+        num_workers=os.cpu_count() or 1,
+        streaming=True
     )
     
     print("\n" + "="*80)
@@ -456,6 +1566,8 @@ def main():
                 print(f"\n{i}. {source['filename']}")
                 print(f"   Type: {source['document_type']}")
                 print(f"   Page: {source['page']} | Section: {source['section']}")
+                for other in source['also_in']:
+                    print(f"   Also in: {other['filename']} | Page: {other['page']} | Section: {other['section']}")
                 print(f"   Preview: {source['content_preview']}")
             
             print("\n" + "="*80)
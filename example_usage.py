@@ -37,7 +37,8 @@ print_section("Initializing Credit Agreement Chatbot")
 chatbot = CreditAgreementChatbot(
     documents_directory="./credit_documents",
     vector_store_path="./vector_store",
-    model_name="gpt-3.5-turbo"  # Change to "gpt-4" for better quality
+    model_name="gpt-3.5-turbo",  # Change to "gpt-4" for better quality
+    streaming=False  # Answers are printed in full below
 )
 
 # Example 1: Basic Covenant Query